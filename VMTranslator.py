@@ -1,5 +1,10 @@
 import argparse
+import contextlib
+import json
 import os
+import sys
+import time
+import tracemalloc
 
 # operations
 ADD = "add"
@@ -30,6 +35,10 @@ IF_COMMAND_TYPE = "C_IF"
 FUNCTION_COMMAND_TYPE = "C_FUNCTION"
 RETURN_COMMAND_TYPE = "C_RETURN"
 CALL_COMMAND_TYPE = "C_CALL"
+# produced by control flow optimization only, jumps if top of stack is false
+IF_NOT_COMMAND_TYPE = "C_IF_NOT"
+JUMP_COMMAND_TYPES = set([GOTO_COMMAND_TYPE, IF_COMMAND_TYPE, IF_NOT_COMMAND_TYPE, RETURN_COMMAND_TYPE])
+CONDITIONAL_JUMP_COMMAND_TYPES = set([IF_COMMAND_TYPE, IF_NOT_COMMAND_TYPE])
 
 # memory segments
 CONSTANT = "constant"
@@ -42,9 +51,59 @@ POINTER = "pointer"
 STATIC = "static"
 
 TEMP_BASE_ADDRESS = 5
+STACK_BASE_ADDRESS = 256
+BOOTSTRAP_FUNCTION_NAME = "Sys.init"
+VM_EXTENSION = ".vm"
 
 SEGMENT_MAPPING = {LOCAL: "LCL", ARGUMENT: "ARG", THIS: "THIS", THAT: "THAT"}
 
+# calling conventions
+# standard: 5 word frame on the stack (return address, LCL, ARG, THIS, THAT)
+# reduced_frame: 3 word frame on the stack (return address, LCL, ARG) for functions that never
+#     change THIS/THAT with pop pointer
+# static_frame: no frame on the stack for functions that never call anything. such a function
+#     cannot be re-entered before it returns, so its return address and the registers it
+#     changes are kept in static words of its own
+STANDARD_CALLING_CONVENTION = "standard"
+REDUCED_FRAME_CALLING_CONVENTION = "reduced_frame"
+STATIC_FRAME_CALLING_CONVENTION = "static_frame"
+STANDARD_SAVED_REGISTERS = ["LCL", "ARG", "THIS", "THAT"]
+REDUCED_FRAME_SAVED_REGISTERS = ["LCL", "ARG"]
+
+# control flow optimization
+# loop headers with at most this many commands are copied to the bottom of the loop
+LOOP_ROTATION_MAX_COMMANDS = 8
+
+# intrinsics
+# calls to these Jack OS functions are replaced with inline hack sequences (or forwarded to
+# the OS function they wrap) instead of going through a full call frame. each entry records
+# the OS source file and the signature it was written against, so that the table can be
+# checked against the OS sources in projects/12 before it is used. only the signature is
+# checked, not the function body. Array.new is not in the table since the OS version checks
+# size > 0 (calling Sys.error 2) before calling Memory.alloc
+MEMORY_PEEK = "Memory.peek"
+MEMORY_POKE = "Memory.poke"
+MEMORY_DEALLOC = "Memory.deAlloc"
+ARRAY_DISPOSE = "Array.dispose"
+INTRINSICS = {
+    MEMORY_PEEK: {"num_args": "1", "source": "Memory.jack",
+                  "signature": "function int peek(int address)", "forward_to": None},
+    MEMORY_POKE: {"num_args": "2", "source": "Memory.jack",
+                  "signature": "function void poke(int address, int value)", "forward_to": None},
+    ARRAY_DISPOSE: {"num_args": "1", "source": "Array.jack",
+                    "signature": "method void dispose()", "forward_to": MEMORY_DEALLOC},
+}
+ALL_INTRINSICS = "all"
+NO_INTRINSICS = "none"
+
+# metrics
+TOP_LEVEL_FUNCTION_NAME = "<top-level>"
+# bootstrap code is counted under this command type and function name
+BOOTSTRAP_METRICS_NAME = "<bootstrap>"
+JSON_METRICS_FORMAT = "json"
+PROMETHEUS_METRICS_FORMAT = "prometheus"
+PROMETHEUS_EXTENSIONS = set([".prom"])
+
 
 def get_output_file_path(input_file_path):
     dirname = os.path.dirname(input_file_path)
@@ -55,12 +114,254 @@ def get_output_file_path(input_file_path):
     return output_file_path
 
 
+def get_input_file_paths(input_paths):
+    # a directory stands for every .vm file in it
+    input_file_paths = list()
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            for filename in sorted(os.listdir(input_path)):
+                if filename.endswith(VM_EXTENSION):
+                    input_file_paths.append(os.path.join(input_path, filename))
+        else:
+            input_file_paths.append(input_path)
+    return input_file_paths
+
+
+def get_program_output_file_path(input_paths):
+    # a single file translates to file.asm, a single directory to dir/dir.asm
+    input_path = input_paths[0]
+    if os.path.isdir(input_path):
+        input_path = os.path.normpath(input_path)
+        return os.path.join(input_path, os.path.basename(input_path) + '.asm')
+    return get_output_file_path(input_path)
+
+
 def get_filename_without_extension(input_file_path):
     filename = os.path.basename(input_file_path)
     filename, _ = os.path.splitext(filename)
     return filename
 
 
+def get_metrics_format(metrics_file_path):
+    _, extension = os.path.splitext(metrics_file_path)
+    if extension in PROMETHEUS_EXTENSIONS:
+        return PROMETHEUS_METRICS_FORMAT
+    return JSON_METRICS_FORMAT
+
+
+def resolve_call(function_name, num_args, intrinsics):
+    # returns the function a call ends up jumping to, or None if it is inlined as an intrinsic
+    while function_name in intrinsics and INTRINSICS[function_name]["num_args"] == num_args:
+        function_name = INTRINSICS[function_name]["forward_to"]
+        if function_name is None:
+            return None
+    return function_name
+
+
+def analyze_calling_conventions(commands, intrinsics):
+    # picks a cheaper calling convention for functions in the file that are only called from the
+    # file, based on whether they call anything, change THIS/THAT or use the local segment.
+    # functions that are never called here (e.g. Sys.init) keep the standard convention since
+    # their callers are not known
+    functions = dict()
+    called_function_names = set()
+    function = None
+    for command in commands:
+        _, command_type, arg1, arg2 = command
+        if command_type == FUNCTION_COMMAND_TYPE:
+            function = {"num_locals": int(arg2), "calls": False, "writes_pointer": False, "uses_local": False}
+            functions[arg1] = function
+        elif command_type == CALL_COMMAND_TYPE:
+            callee_name = resolve_call(arg1, arg2, intrinsics)
+            if callee_name is None:
+                continue
+            called_function_names.add(callee_name)
+            if function is not None:
+                function["calls"] = True
+        elif function is not None and command_type == POP_COMMAND_TYPE and arg1 == POINTER:
+            function["writes_pointer"] = True
+        elif function is not None and command_type in set([PUSH_COMMAND_TYPE, POP_COMMAND_TYPE]) and arg1 == LOCAL:
+            function["uses_local"] = True
+
+    calling_conventions = dict()
+    for function_name, function in functions.items():
+        if function_name not in called_function_names:
+            continue
+        if not function["calls"]:
+            saved_registers = ["ARG"]
+            if function["num_locals"] > 0 or function["uses_local"]:
+                saved_registers.insert(0, "LCL")
+            if function["writes_pointer"]:
+                saved_registers.extend(["THIS", "THAT"])
+            calling_conventions[function_name] = {
+                "convention": STATIC_FRAME_CALLING_CONVENTION, "saved_registers": saved_registers}
+        elif not function["writes_pointer"]:
+            calling_conventions[function_name] = {
+                "convention": REDUCED_FRAME_CALLING_CONVENTION, "saved_registers": REDUCED_FRAME_SAVED_REGISTERS}
+    return calling_conventions
+
+
+def _normalize_whitespace(text):
+    return " ".join(text.split())
+
+
+def parse_intrinsic_names(value):
+    # value is a comma separated list of OS functions, "all" or "none"
+    if value == NO_INTRINSICS:
+        return set()
+    if value == ALL_INTRINSICS:
+        return set(INTRINSICS)
+    names = set(name.strip() for name in value.split(",") if name.strip())
+    unknown_names = names - set(INTRINSICS)
+    if unknown_names:
+        raise argparse.ArgumentTypeError("unknown intrinsics: {} (available: {})".format(
+            ", ".join(sorted(unknown_names)), ", ".join(sorted(INTRINSICS))))
+    return names
+
+
+def get_enabled_intrinsics(names, os_dir=None, defined_function_names=None):
+    # functions the translated program defines itself (e.g. a Memory.vm being tested) are
+    # always called, never replaced
+    if defined_function_names is not None:
+        names = set(names) - set(defined_function_names)
+    if os_dir is None:
+        return set(names)
+
+    # drop intrinsics whose OS function no longer matches the signature they were written against
+    enabled_names = set()
+    for name in sorted(names):
+        intrinsic = INTRINSICS[name]
+        source_path = os.path.join(os_dir, intrinsic["source"])
+        source = ""
+        if os.path.exists(source_path):
+            with open(source_path, 'r') as source_file:
+                source = _normalize_whitespace(source_file.read())
+        if _normalize_whitespace(intrinsic["signature"]) in source:
+            enabled_names.add(name)
+        else:
+            sys.stderr.write("intrinsic {} disabled: '{}' not found in {}\n".format(
+                name, intrinsic["signature"], source_path))
+    return enabled_names
+
+
+def count_instructions(assembly):
+    # counts hack instructions in assembly, skipping comments, labels and blank lines
+    count = 0
+    for line in assembly.split("\n"):
+        line = line.strip()
+        if line and not line.startswith("//") and not line.startswith("("):
+            count += 1
+    return count
+
+
+class Metrics(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        # phase name -> wall time, bytes allocated, net change in allocated memory blocks
+        # (negative when a phase frees more than it allocates) and number of times entered
+        self.phases = dict()
+        self.instructions_by_command_type = dict()
+        self.instructions_by_function = dict()
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # records wall time, allocated bytes and the net change in allocated memory blocks inside
+        # the block. allocated bytes is the peak memory traced by tracemalloc above the level the
+        # block started at, summed over every time the block is entered, so memory that is
+        # allocated and freed again within the block still counts. phases must not be nested
+        if not self.enabled:
+            yield
+            return
+        start_blocks = sys.getallocatedblocks()
+        tracemalloc.reset_peak()
+        start_traced_bytes, _ = tracemalloc.get_traced_memory()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            _, peak_traced_bytes = tracemalloc.get_traced_memory()
+            net_allocated_blocks = sys.getallocatedblocks() - start_blocks
+            record = self.phases.setdefault(
+                name, {"seconds": 0.0, "allocated_bytes": 0, "net_allocated_blocks": 0, "count": 0})
+            record["seconds"] += elapsed
+            record["allocated_bytes"] += peak_traced_bytes - start_traced_bytes
+            record["net_allocated_blocks"] += net_allocated_blocks
+            record["count"] += 1
+
+    def add_instructions(self, command_type, function_name, count):
+        if not self.enabled:
+            return
+        by_type = self.instructions_by_command_type
+        by_type[command_type] = by_type.get(command_type, 0) + count
+        by_function = self.instructions_by_function
+        by_function[function_name] = by_function.get(function_name, 0) + count
+
+    def to_dict(self):
+        return {
+            "phases": self.phases,
+            "instructions": {
+                "total": sum(self.instructions_by_command_type.values()),
+                "by_command_type": self.instructions_by_command_type,
+                "by_function": self.instructions_by_function,
+            },
+        }
+
+    def _get_prometheus_label(self, value):
+        value = value.replace("\\", "\\\\").replace('"', '\\"')
+        return value
+
+    def to_prometheus(self):
+        lines = list()
+        lines.append("# HELP vmtranslator_phase_seconds Wall time spent in each translation phase.")
+        lines.append("# TYPE vmtranslator_phase_seconds gauge")
+        for name in sorted(self.phases):
+            lines.append('vmtranslator_phase_seconds{{phase="{}"}} {:.9f}'.format(
+                self._get_prometheus_label(name), self.phases[name]["seconds"]))
+        lines.append("# HELP vmtranslator_phase_allocated_bytes Peak bytes allocated above the starting level "
+                     "in each translation phase, summed over every time the phase was entered.")
+        lines.append("# TYPE vmtranslator_phase_allocated_bytes gauge")
+        for name in sorted(self.phases):
+            lines.append('vmtranslator_phase_allocated_bytes{{phase="{}"}} {}'.format(
+                self._get_prometheus_label(name), self.phases[name]["allocated_bytes"]))
+        lines.append("# HELP vmtranslator_phase_net_allocated_blocks Net change in allocated memory blocks "
+                     "in each translation phase.")
+        lines.append("# TYPE vmtranslator_phase_net_allocated_blocks gauge")
+        for name in sorted(self.phases):
+            lines.append('vmtranslator_phase_net_allocated_blocks{{phase="{}"}} {}'.format(
+                self._get_prometheus_label(name), self.phases[name]["net_allocated_blocks"]))
+        lines.append("# HELP vmtranslator_phase_count Number of times each translation phase was entered.")
+        lines.append("# TYPE vmtranslator_phase_count gauge")
+        for name in sorted(self.phases):
+            lines.append('vmtranslator_phase_count{{phase="{}"}} {}'.format(
+                self._get_prometheus_label(name), self.phases[name]["count"]))
+        lines.append("# HELP vmtranslator_instructions Hack instructions emitted per VM command type.")
+        lines.append("# TYPE vmtranslator_instructions gauge")
+        for command_type in sorted(self.instructions_by_command_type):
+            lines.append('vmtranslator_instructions{{command_type="{}"}} {}'.format(
+                self._get_prometheus_label(command_type), self.instructions_by_command_type[command_type]))
+        lines.append("# HELP vmtranslator_function_instructions Hack instructions emitted per VM function.")
+        lines.append("# TYPE vmtranslator_function_instructions gauge")
+        for function_name in sorted(self.instructions_by_function):
+            lines.append('vmtranslator_function_instructions{{function="{}"}} {}'.format(
+                self._get_prometheus_label(function_name), self.instructions_by_function[function_name]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_file_path, metrics_format=None):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if metrics_format is None:
+            metrics_format = get_metrics_format(metrics_file_path)
+        with open(metrics_file_path, 'w') as metrics_file:
+            if metrics_format == PROMETHEUS_METRICS_FORMAT:
+                metrics_file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), metrics_file, indent=2, sort_keys=True)
+                metrics_file.write("\n")
+
+
 class Parser(object):
     def __init__(self, input_file_path):
         self.vm_file = open(input_file_path, 'r')
@@ -95,6 +396,9 @@ class Parser(object):
         # sets current_command
         self.current_command = self.vm_file.readline().strip()
 
+    def close(self):
+        self.vm_file.close()
+
     def command_type(self):
         operation = self.current_command.split()[0]
         if operation in ARITHMETIC_OPERATIONS:
@@ -130,16 +434,27 @@ class Parser(object):
         operation = self.current_command.split()[0]
         if operation in ARITHMETIC_OPERATIONS:
             return None
-        elif operation in PUSH_POP_OPERATIONS:
+        elif operation in PUSH_POP_OPERATIONS or operation in FUNCTION_OPERATIONS or operation in CALL_OPERATIONS:
             operation, arg1, arg2 = self.current_command.split()[:3]
             return arg2
 
 
 class CodeWriter(object):
-    def __init__(self, output_file_path):
+    def __init__(self, output_file_path, metrics=None, intrinsics=None, calling_conventions=None):
         self.assembly_file = open(output_file_path, 'w')
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.intrinsics = intrinsics if intrinsics is not None else set(INTRINSICS)
+        # function name -> calling convention, functions not in here use the standard one
+        self.calling_conventions = calling_conventions if calling_conventions is not None else dict()
+        self._function_name = None
+        self._return_label_num = 0
+        # assembly is buffered so that writing the output file is a phase of its own
+        self._assembly = list()
         self._if_else_block_num = 0
 
+    def _write(self, assembly):
+        self._assembly.append(assembly)
+
     def _get_push_command(self, arg, constant=False):
         commands = list()
         # bring variable into D
@@ -342,91 +657,91 @@ class CodeWriter(object):
     def _write_binary_commands(self, operator):
         # store variable2 in R13
         pop_command = self._get_pop_command("R13")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # store variable1 in R14
         pop_command = self._get_pop_command("R14")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # perform operation based on operator
         if operator == ADD:
             # add R13 and R14 and store in R13
             add_command = self._get_add_command("R14", "R13")
-            self.assembly_file.write(add_command + "\n")
+            self._write(add_command + "\n")
         elif operator == SUB:
             sub_command = self._get_sub_command("R14", "R13")
-            self.assembly_file.write(sub_command + "\n")
+            self._write(sub_command + "\n")
         elif operator == AND:
             and_command = self._get_and_command("R14", "R13")
-            self.assembly_file.write(and_command + "\n")
+            self._write(and_command + "\n")
         elif operator == OR:
             or_command = self._get_or_command("R14", "R13")
-            self.assembly_file.write(or_command + "\n")
+            self._write(or_command + "\n")
         # push R13 onto stack
         push_command = self._get_push_command("R14")
-        self.assembly_file.write(push_command + "\n")
+        self._write(push_command + "\n")
 
     def _write_eq_commands(self):
         # first pop
         pop_command = self._get_pop_command("R13")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # second pop
         pop_command = self._get_pop_command("R14")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # write eq commands
         eq_command = self._get_eq_command("R14", "R13")
-        self.assembly_file.write(eq_command + "\n")
+        self._write(eq_command + "\n")
         # push R14 onto stack
         push_command = self._get_push_command("R14")
-        self.assembly_file.write(push_command + "\n")
+        self._write(push_command + "\n")
 
     def _write_gt_commands(self):
         # first pop
         pop_command = self._get_pop_command("R13")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # second pop
         pop_command = self._get_pop_command("R14")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # write gt commands
         gt_command = self._get_gt_command("R14", "R13")
-        self.assembly_file.write(gt_command + "\n")
+        self._write(gt_command + "\n")
         # push R14 onto stack
         push_command = self._get_push_command("R14")
-        self.assembly_file.write(push_command + "\n")
+        self._write(push_command + "\n")
 
     def _write_lt_commands(self):
         # first pop
         pop_command = self._get_pop_command("R13")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # second pop
         pop_command = self._get_pop_command("R14")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # write lt commands
         lt_command = self._get_lt_command("R14", "R13")
-        self.assembly_file.write(lt_command + "\n")
+        self._write(lt_command + "\n")
         # push R14 onto stack
         push_command = self._get_push_command("R14")
-        self.assembly_file.write(push_command + "\n")
+        self._write(push_command + "\n")
 
     def _write_not_commands(self):
         # first pop
         pop_command = self._get_pop_command("R13")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # write not commands
         not_command = self._get_not_command("R13")
-        self.assembly_file.write(not_command + "\n")
+        self._write(not_command + "\n")
         # push R13 onto stack
         push_command = self._get_push_command("R13")
-        self.assembly_file.write(push_command + "\n")
+        self._write(push_command + "\n")
 
     def _write_neg_commands(self):
         # first pop
         pop_command = self._get_pop_command("R13")
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
         # write neg commands
         neg_command = self._get_neg_command("R13")
-        self.assembly_file.write(neg_command + "\n")
+        self._write(neg_command + "\n")
         # push R13 onto stack
         push_command = self._get_push_command("R13")
-        self.assembly_file.write(push_command + "\n")
+        self._write(push_command + "\n")
 
     def _get_temp_push_command(self, offset):
         commands = list()
@@ -520,7 +835,7 @@ class CodeWriter(object):
             arg = arg2
             push_command = self._get_static_push_command(arg, filename)
 
-        self.assembly_file.write(push_command + "\n")
+        self._write(push_command + "\n")
 
     def _get_temp_pop_command(self, offset):
         commands = list()
@@ -614,7 +929,21 @@ class CodeWriter(object):
         commands.append("D=M")
         # if D is not false jump to label
         commands.append("@{}".format(label))
-        commands.append("!D;JNE")
+        commands.append("D;JNE")
+
+        return '\n'.join(commands)
+
+    def _get_if_not_command(self, label):
+        commands = list()
+        # decrement stack pointer
+        commands.append("@SP")
+        commands.append("M=M-1")
+        # store top of stack in D
+        commands.append("A=M")
+        commands.append("D=M")
+        # if D is false jump to label
+        commands.append("@{}".format(label))
+        commands.append("D;JEQ")
 
         return '\n'.join(commands)
 
@@ -624,6 +953,244 @@ class CodeWriter(object):
         commands.append("0;JMP")
         return '\n'.join(commands)
 
+    def _get_peek_intrinsic_command(self):
+        # replaces the address on top of the stack with the RAM value at that address
+        commands = list()
+        # store RAM[address] in D
+        commands.append("@SP")
+        commands.append("A=M-1")
+        commands.append("A=M")
+        commands.append("D=M")
+        # overwrite address on top of stack with D
+        commands.append("@SP")
+        commands.append("A=M-1")
+        commands.append("M=D")
+        return '\n'.join(commands)
+
+    def _get_poke_intrinsic_command(self):
+        # pops value and address and sets RAM[address] to value, leaving 0 as the return value
+        commands = list()
+        # decrement stack pointer and store value in D
+        commands.append("@SP")
+        commands.append("AM=M-1")
+        commands.append("D=M")
+        # set A to address, which is just below value
+        commands.append("A=A-1")
+        commands.append("A=M")
+        # write value to address
+        commands.append("M=D")
+        # replace address on top of stack with return value 0
+        commands.append("@SP")
+        commands.append("A=M-1")
+        commands.append("M=0")
+        return '\n'.join(commands)
+
+    def _write_intrinsic_commands(self, function_name):
+        intrinsic = INTRINSICS[function_name]
+        if intrinsic["forward_to"] is not None:
+            # the OS function only wraps another one, so call that directly
+            self.write_call(intrinsic["forward_to"], intrinsic["num_args"])
+            return
+        if function_name == MEMORY_PEEK:
+            command = self._get_peek_intrinsic_command()
+        elif function_name == MEMORY_POKE:
+            command = self._get_poke_intrinsic_command()
+        self._write(command + "\n")
+
+    def _get_calling_convention(self, function_name):
+        standard_calling_convention = {
+            "convention": STANDARD_CALLING_CONVENTION, "saved_registers": STANDARD_SAVED_REGISTERS}
+        return self.calling_conventions.get(function_name, standard_calling_convention)
+
+    def _get_frame_variable(self, function_name, register):
+        # static word holding register (or the return address) for a static frame function
+        return "{}$frame.{}".format(function_name, register)
+
+    def _get_function_command(self, function_name, num_locals):
+        commands = list()
+        commands.append("({})".format(function_name))
+        calling_convention = self._get_calling_convention(function_name)
+        if calling_convention["convention"] == STATIC_FRAME_CALLING_CONVENTION:
+            saved_registers = calling_convention["saved_registers"]
+            # save the caller's registers this function changes, ARG is saved by the caller
+            for register in saved_registers:
+                if register == "ARG":
+                    continue
+                commands.append("@{}".format(register))
+                commands.append("D=M")
+                commands.append("@{}".format(self._get_frame_variable(function_name, register)))
+                commands.append("M=D")
+            if "LCL" in saved_registers:
+                # set LCL to SP
+                commands.append("@SP")
+                commands.append("D=M")
+                commands.append("@LCL")
+                commands.append("M=D")
+        for _ in range(int(num_locals)):
+            # push 0 for each local variable
+            commands.append("@SP")
+            commands.append("A=M")
+            commands.append("M=0")
+            commands.append("@SP")
+            commands.append("M=M+1")
+        return '\n'.join(commands)
+
+    def _get_call_command(self, function_name, num_args, return_label):
+        commands = list()
+        saved_registers = self._get_calling_convention(function_name)["saved_registers"]
+        frame_size = len(saved_registers) + 1
+        # push return address
+        commands.append("@{}".format(return_label))
+        commands.append("D=A")
+        commands.append("@SP")
+        commands.append("A=M")
+        commands.append("M=D")
+        commands.append("@SP")
+        commands.append("M=M+1")
+        for register in saved_registers:
+            # push register
+            commands.append("@{}".format(register))
+            commands.append("D=M")
+            commands.append("@SP")
+            commands.append("A=M")
+            commands.append("M=D")
+            commands.append("@SP")
+            commands.append("M=M+1")
+        # set ARG to SP - frame size - num_args
+        commands.append("@SP")
+        commands.append("D=M")
+        commands.append("@{}".format(frame_size + int(num_args)))
+        commands.append("D=D-A")
+        commands.append("@ARG")
+        commands.append("M=D")
+        # set LCL to SP
+        commands.append("@SP")
+        commands.append("D=M")
+        commands.append("@LCL")
+        commands.append("M=D")
+        # jump to function
+        commands.append("@{}".format(function_name))
+        commands.append("0;JMP")
+        commands.append("({})".format(return_label))
+        return '\n'.join(commands)
+
+    def _get_static_frame_call_command(self, function_name, num_args, return_label):
+        commands = list()
+        # save ARG in the function's frame
+        commands.append("@ARG")
+        commands.append("D=M")
+        commands.append("@{}".format(self._get_frame_variable(function_name, "ARG")))
+        commands.append("M=D")
+        # set ARG to SP - num_args
+        commands.append("@SP")
+        commands.append("D=M")
+        commands.append("@{}".format(num_args))
+        commands.append("D=D-A")
+        commands.append("@ARG")
+        commands.append("M=D")
+        # store return address in the function's frame
+        commands.append("@{}".format(return_label))
+        commands.append("D=A")
+        commands.append("@{}".format(self._get_frame_variable(function_name, "return")))
+        commands.append("M=D")
+        # jump to function
+        commands.append("@{}".format(function_name))
+        commands.append("0;JMP")
+        commands.append("({})".format(return_label))
+        return '\n'.join(commands)
+
+    def _get_return_command(self, saved_registers):
+        commands = list()
+        frame_size = len(saved_registers) + 1
+        # store frame (LCL) in R13
+        commands.append("@LCL")
+        commands.append("D=M")
+        commands.append("@R13")
+        commands.append("M=D")
+        # store return address (frame - frame size) in R14
+        commands.append("@{}".format(frame_size))
+        commands.append("A=D-A")
+        commands.append("D=M")
+        commands.append("@R14")
+        commands.append("M=D")
+        # pop return value into *ARG
+        commands.append("@SP")
+        commands.append("AM=M-1")
+        commands.append("D=M")
+        commands.append("@ARG")
+        commands.append("A=M")
+        commands.append("M=D")
+        # set SP to ARG + 1
+        commands.append("@ARG")
+        commands.append("D=M+1")
+        commands.append("@SP")
+        commands.append("M=D")
+        for offset, register in enumerate(reversed(saved_registers), 1):
+            # restore register from frame - offset
+            commands.append("@R13")
+            commands.append("D=M")
+            commands.append("@{}".format(offset))
+            commands.append("A=D-A")
+            commands.append("D=M")
+            commands.append("@{}".format(register))
+            commands.append("M=D")
+        # jump to return address
+        commands.append("@R14")
+        commands.append("A=M")
+        commands.append("0;JMP")
+        return '\n'.join(commands)
+
+    def _get_static_frame_return_command(self, function_name, saved_registers):
+        commands = list()
+        # pop return value into *ARG
+        commands.append("@SP")
+        commands.append("AM=M-1")
+        commands.append("D=M")
+        commands.append("@ARG")
+        commands.append("A=M")
+        commands.append("M=D")
+        # set SP to ARG + 1
+        commands.append("@ARG")
+        commands.append("D=M+1")
+        commands.append("@SP")
+        commands.append("M=D")
+        for register in saved_registers:
+            # restore register from the function's frame
+            commands.append("@{}".format(self._get_frame_variable(function_name, register)))
+            commands.append("D=M")
+            commands.append("@{}".format(register))
+            commands.append("M=D")
+        # jump to return address
+        commands.append("@{}".format(self._get_frame_variable(function_name, "return")))
+        commands.append("A=M")
+        commands.append("0;JMP")
+        return '\n'.join(commands)
+
+    def _write_function_commands(self, function_name, num_locals):
+        command = self._get_function_command(function_name, num_locals)
+        self._write(command + "\n")
+
+    def _write_call_commands(self, function_name, num_args):
+        return_label = "{}$ret.{}".format(self._function_name or "", self._return_label_num)
+        self._return_label_num += 1
+        if self._get_calling_convention(function_name)["convention"] == STATIC_FRAME_CALLING_CONVENTION:
+            command = self._get_static_frame_call_command(function_name, num_args, return_label)
+        else:
+            command = self._get_call_command(function_name, num_args, return_label)
+        self._write(command + "\n")
+
+    def _write_return_commands(self):
+        calling_convention = self._get_calling_convention(self._function_name)
+        saved_registers = calling_convention["saved_registers"]
+        if calling_convention["convention"] == STATIC_FRAME_CALLING_CONVENTION:
+            command = self._get_static_frame_return_command(self._function_name, saved_registers)
+        else:
+            command = self._get_return_command(saved_registers)
+        self._write(command + "\n")
+
+    def _is_intrinsic(self, function_name, num_args):
+        return function_name in self.intrinsics and INTRINSICS[function_name]["num_args"] == num_args
+
     def _write_pop_commands(self, arg1, arg2, filename):
         # pop top of stack and store onto the right place in memory using arg1, arg2
         if arg1 in SEGMENT_MAPPING:
@@ -640,19 +1207,23 @@ class CodeWriter(object):
             arg = arg2
             pop_command = self._get_static_pop_command(arg, filename)
 
-        self.assembly_file.write(pop_command + "\n")
+        self._write(pop_command + "\n")
 
     def _write_label_commands(self, label):
         command = self._get_label_command(label)
-        self.assembly_file.write(command + "\n")
+        self._write(command + "\n")
 
     def _write_if_commands(self, label):
         command = self._get_if_command(label)
-        self.assembly_file.write(command + "\n")
+        self._write(command + "\n")
+
+    def _write_if_not_commands(self, label):
+        command = self._get_if_not_command(label)
+        self._write(command + "\n")
 
     def _write_goto_commands(self, label):
         command = self._get_goto_command(label)
-        self.assembly_file.write(command + "\n")
+        self._write(command + "\n")
 
     def write_arithmetic(self, command):
         # this function converts an arithmetic command in vm code to assembly code
@@ -672,59 +1243,423 @@ class CodeWriter(object):
             self._write_not_commands()
 
     def write_push_pop(self, command, arg1, arg2, filename):
-        # self.assembly_file.write(command + " " + segment + " " + index + "\n")
+        # self._write(command + " " + segment + " " + index + "\n")
         if command == PUSH_COMMAND_TYPE:
             self._write_push_commands(arg1, arg2, filename)
         elif command == POP_COMMAND_TYPE:
             self._write_pop_commands(arg1, arg2, filename)
 
+    def start_file(self):
+        # code before the first function of a file does not belong to the previous file's function
+        self._function_name = None
+
+    def write_bootstrap(self):
+        commands = list()
+        # set SP to the stack base address
+        commands.append("@{}".format(STACK_BASE_ADDRESS))
+        commands.append("D=A")
+        commands.append("@SP")
+        commands.append("M=D")
+        self._write('\n'.join(commands) + "\n")
+        self.write_call(BOOTSTRAP_FUNCTION_NAME, "0")
+
+    def write_function(self, function_name, num_locals):
+        self._function_name = function_name
+        self._write_function_commands(function_name, num_locals)
+
+    def write_call(self, function_name, num_args):
+        if self._is_intrinsic(function_name, num_args):
+            self._write_intrinsic_commands(function_name)
+        else:
+            self._write_call_commands(function_name, num_args)
+
+    def write_return(self):
+        self._write_return_commands()
+
     def write_comment(self, comment):
-        self.assembly_file.write("// " + comment + "\n")
+        self._write("// " + comment + "\n")
+
+    def _get_function_label(self, label):
+        # vm labels are scoped to the function they appear in
+        if self._function_name is None:
+            return label
+        return "{}${}".format(self._function_name, label)
 
     def write_label(self, label):
-        self._write_label_commands(label)
+        self._write_label_commands(self._get_function_label(label))
 
     def write_if(self, label):
-        self._write_if_commands(label)
+        self._write_if_commands(self._get_function_label(label))
+
+    def write_if_not(self, label):
+        self._write_if_not_commands(self._get_function_label(label))
 
     def write_goto(self, label):
-        self._write_goto_commands(label)
+        self._write_goto_commands(self._get_function_label(label))
 
-    def close(self):
-        self.assembly_file.close()
+    def get_assembly_since(self, position):
+        # returns the assembly written after the given buffer position
+        return "".join(self._assembly[position:])
 
+    def get_position(self):
+        return len(self._assembly)
 
-def main(args):
-    input_file_path = args.file_path
-    # create_file(input_file_path)
-    parser = Parser(input_file_path)
-    output_file_path = get_output_file_path(input_file_path)
-    filename = get_filename_without_extension(input_file_path)
-    code_writer = CodeWriter(output_file_path)
+    def close(self):
+        with self.metrics.phase("write"):
+            self.assembly_file.write("".join(self._assembly))
+            self.assembly_file.close()
+
+
+def make_jump_command(command_type, label):
+    if command_type == GOTO_COMMAND_TYPE:
+        operation = "goto"
+    elif command_type == IF_COMMAND_TYPE:
+        operation = "if-goto"
+    elif command_type == IF_NOT_COMMAND_TYPE:
+        operation = "if-not-goto"
+    return ("{} {}".format(operation, label), command_type, label, None)
+
+
+def make_label_command(label):
+    return ("label {}".format(label), LABEL_COMMAND_TYPE, label, None)
+
+
+class ControlFlowGraph(object):
+    # basic blocks of a single vm function. each block is a dict holding the label it starts
+    # with (if any), its straight line commands and the goto/if-goto/return that ends it (if any)
+
+    def __init__(self, commands):
+        self.blocks = list()
+        self._build_blocks(commands)
+
+    def _new_block(self, label=None):
+        block = {"label": label, "commands": list(), "jump": None}
+        self.blocks.append(block)
+        return block
+
+    def _is_empty_block(self, block):
+        return not block["commands"] and block["jump"] is None
+
+    def _build_blocks(self, commands):
+        block = self._new_block()
+        for command in commands:
+            command_type = command[1]
+            if command_type == LABEL_COMMAND_TYPE:
+                if block["label"] is None and self._is_empty_block(block):
+                    block["label"] = command[2]
+                else:
+                    block = self._new_block(command[2])
+            elif command_type in JUMP_COMMAND_TYPES:
+                block["jump"] = command
+                block = self._new_block()
+            else:
+                block["commands"].append(command)
+        # drop the empty block opened after a trailing jump
+        if len(self.blocks) > 1 and block["label"] is None and self._is_empty_block(block):
+            self.blocks.pop()
+
+    def _get_label_indexes(self):
+        label_indexes = dict()
+        for index, block in enumerate(self.blocks):
+            if block["label"] is not None:
+                label_indexes[block["label"]] = index
+        return label_indexes
+
+    def _get_jump_type(self, block):
+        if block["jump"] is None:
+            return None
+        return block["jump"][1]
+
+    def _get_jump_target(self, block):
+        if self._get_jump_type(block) in set([GOTO_COMMAND_TYPE, IF_COMMAND_TYPE, IF_NOT_COMMAND_TYPE]):
+            return block["jump"][2]
+        return None
+
+    def _get_successors(self, index, label_indexes):
+        block = self.blocks[index]
+        jump_type = self._get_jump_type(block)
+        successors = list()
+        target = self._get_jump_target(block)
+        if target in label_indexes:
+            successors.append(label_indexes[target])
+        if (jump_type is None or jump_type in CONDITIONAL_JUMP_COMMAND_TYPES) and index + 1 < len(self.blocks):
+            successors.append(index + 1)
+        return successors
+
+    def _resolve_label(self, label, label_indexes):
+        # follows empty blocks that only fall through or goto somewhere else
+        visited = set()
+        while label in label_indexes and label not in visited:
+            visited.add(label)
+            index = label_indexes[label]
+            block = self.blocks[index]
+            if block["commands"]:
+                break
+            jump_type = self._get_jump_type(block)
+            if jump_type == GOTO_COMMAND_TYPE:
+                label = self._get_jump_target(block)
+            elif jump_type is None and index + 1 < len(self.blocks) and self.blocks[index + 1]["label"] is not None:
+                label = self.blocks[index + 1]["label"]
+            else:
+                break
+        return label
+
+    def thread_jumps(self):
+        # retargets jumps to gotos (and to empty blocks) at their final destination
+        label_indexes = self._get_label_indexes()
+        for block in self.blocks:
+            target = self._get_jump_target(block)
+            if target is None:
+                continue
+            resolved_target = self._resolve_label(target, label_indexes)
+            if resolved_target != target:
+                block["jump"] = make_jump_command(self._get_jump_type(block), resolved_target)
+
+    def invert_branches(self):
+        # if-goto A; goto B; label A  =>  if-not-goto B; label A (and the other way round)
+        index = 0
+        while index + 2 < len(self.blocks):
+            block = self.blocks[index]
+            next_block = self.blocks[index + 1]
+            jump_type = self._get_jump_type(block)
+            if (jump_type in CONDITIONAL_JUMP_COMMAND_TYPES
+                    and next_block["label"] is None
+                    and not next_block["commands"]
+                    and self._get_jump_type(next_block) == GOTO_COMMAND_TYPE
+                    and self.blocks[index + 2]["label"] == self._get_jump_target(block)):
+                if jump_type == IF_COMMAND_TYPE:
+                    inverted_jump_type = IF_NOT_COMMAND_TYPE
+                else:
+                    inverted_jump_type = IF_COMMAND_TYPE
+                block["jump"] = make_jump_command(inverted_jump_type, self._get_jump_target(next_block))
+                del self.blocks[index + 1]
+            index += 1
+
+    def _get_used_labels(self):
+        labels = set()
+        for block in self.blocks:
+            if block["label"] is not None:
+                labels.add(block["label"])
+            if self._get_jump_target(block) is not None:
+                labels.add(self._get_jump_target(block))
+        return labels
+
+    def _get_body_label(self, header_label, used_labels):
+        # label for a loop body the vm code does not label itself (as the Jack compiler emits
+        # while loops), not clashing with any label used in the function
+        body_label = "{}$body".format(header_label)
+        num = 0
+        while body_label in used_labels:
+            num += 1
+            body_label = "{}$body{}".format(header_label, num)
+        used_labels.add(body_label)
+        return body_label
+
+    def rotate_loops(self, max_commands=LOOP_ROTATION_MAX_COMMANDS):
+        # a loop that ends with goto back to a small header testing the loop condition gets a
+        # copy of the header instead, so each iteration tests the condition and branches back
+        # without first jumping to the top of the loop
+        label_indexes = self._get_label_indexes()
+        used_labels = self._get_used_labels()
+        blocks = list()
+        for index, block in enumerate(self.blocks):
+            blocks.append(block)
+            header_index = label_indexes.get(self._get_jump_target(block))
+            if self._get_jump_type(block) != GOTO_COMMAND_TYPE or header_index is None or header_index >= index:
+                continue
+            header = self.blocks[header_index]
+            if (self._get_jump_type(header) not in CONDITIONAL_JUMP_COMMAND_TYPES
+                    or len(header["commands"]) > max_commands
+                    or header_index + 1 >= len(self.blocks)):
+                continue
+            body = self.blocks[header_index + 1]
+            if body["label"] is None:
+                body["label"] = self._get_body_label(header["label"], used_labels)
+            block["commands"] = block["commands"] + header["commands"]
+            block["jump"] = header["jump"]
+            # continue into the loop body like the header does
+            body_jump = make_jump_command(GOTO_COMMAND_TYPE, body["label"])
+            blocks.append({"label": None, "commands": list(), "jump": body_jump})
+        self.blocks = blocks
+
+    def remove_unreachable_blocks(self):
+        label_indexes = self._get_label_indexes()
+        reachable = set()
+        pending = [0]
+        while pending:
+            index = pending.pop()
+            if index in reachable:
+                continue
+            reachable.add(index)
+            pending.extend(self._get_successors(index, label_indexes))
+        self.blocks = [block for index, block in enumerate(self.blocks) if index in reachable]
+
+    def remove_jumps_to_next_block(self):
+        for index, block in enumerate(self.blocks[:-1]):
+            if (self._get_jump_type(block) == GOTO_COMMAND_TYPE
+                    and self._get_jump_target(block) == self.blocks[index + 1]["label"]):
+                block["jump"] = None
+
+    def optimize(self):
+        self.thread_jumps()
+        self.remove_unreachable_blocks()
+        self.invert_branches()
+        self.rotate_loops()
+        self.thread_jumps()
+        self.remove_unreachable_blocks()
+        self.invert_branches()
+        self.remove_jumps_to_next_block()
+
+    def get_commands(self):
+        commands = list()
+        for block in self.blocks:
+            if block["label"] is not None:
+                commands.append(make_label_command(block["label"]))
+            commands.extend(block["commands"])
+            if block["jump"] is not None:
+                commands.append(block["jump"])
+        return commands
+
+
+def optimize_control_flow(commands):
+    # builds a control flow graph for the code before the first function and for each function
+    optimized_commands = list()
+    function_commands = list()
+    for command in commands + [None]:
+        if command is None or command[1] == FUNCTION_COMMAND_TYPE:
+            if function_commands:
+                control_flow_graph = ControlFlowGraph(function_commands)
+                control_flow_graph.optimize()
+                optimized_commands.extend(control_flow_graph.get_commands())
+            function_commands = list()
+        if command is not None:
+            function_commands.append(command)
+    return optimized_commands
+
+
+def parse_commands(parser):
+    # reads every command in the vm file into (command, command_type, arg1, arg2) tuples
+    commands = list()
     while parser.has_more_commands():
         parser.advance()
-        code_writer.write_comment(parser.current_command)
         command_type = parser.command_type()
+        arg1 = None
+        arg2 = None
         if command_type != RETURN_COMMAND_TYPE:
             arg1 = parser.arg1()
-            if command_type == ARITHMETIC_COMMAND_TYPE:
-                code_writer.write_arithmetic(arg1)
-            elif command_type == LABEL_COMMAND_TYPE:
-                code_writer.write_label(arg1)
-            elif command_type == IF_COMMAND_TYPE:
-                code_writer.write_if(arg1)
-            elif command_type == GOTO_COMMAND_TYPE:
-                code_writer.write_goto(arg1)
-
         if command_type in set([PUSH_COMMAND_TYPE, POP_COMMAND_TYPE, FUNCTION_COMMAND_TYPE, CALL_COMMAND_TYPE]):
             arg2 = parser.arg2()
-            code_writer.write_push_pop(command_type, arg1, arg2, filename)
+        commands.append((parser.current_command, command_type, arg1, arg2))
+    return commands
+
+
+def write_command(code_writer, command, filename):
+    current_command, command_type, arg1, arg2 = command
+    code_writer.write_comment(current_command)
+    if command_type == ARITHMETIC_COMMAND_TYPE:
+        code_writer.write_arithmetic(arg1)
+    elif command_type == LABEL_COMMAND_TYPE:
+        code_writer.write_label(arg1)
+    elif command_type == IF_COMMAND_TYPE:
+        code_writer.write_if(arg1)
+    elif command_type == IF_NOT_COMMAND_TYPE:
+        code_writer.write_if_not(arg1)
+    elif command_type == GOTO_COMMAND_TYPE:
+        code_writer.write_goto(arg1)
+    elif command_type == FUNCTION_COMMAND_TYPE:
+        code_writer.write_function(arg1, arg2)
+    elif command_type == CALL_COMMAND_TYPE:
+        code_writer.write_call(arg1, arg2)
+    elif command_type == RETURN_COMMAND_TYPE:
+        code_writer.write_return()
+    elif command_type in set([PUSH_COMMAND_TYPE, POP_COMMAND_TYPE]):
+        code_writer.write_push_pop(command_type, arg1, arg2, filename)
+
+
+def main(args):
+    input_file_paths = get_input_file_paths(args.paths)
+    metrics = Metrics(enabled=args.metrics is not None)
+    # filename (used for static variables) -> commands in that file
+    program = list()
+    for input_file_path in input_file_paths:
+        with metrics.phase("parse"):
+            parser = Parser(input_file_path)
+            commands = parse_commands(parser)
+            parser.close()
+        if args.optimize_control_flow:
+            with metrics.phase("optimize.control_flow"):
+                commands = optimize_control_flow(commands)
+        program.append((get_filename_without_extension(input_file_path), commands))
+    if args.output is not None:
+        output_file_path = args.output
+    else:
+        output_file_path = get_program_output_file_path(args.paths)
+    defined_function_names = set(
+        command[2] for _, commands in program for command in commands if command[1] == FUNCTION_COMMAND_TYPE)
+    intrinsics = get_enabled_intrinsics(args.intrinsics, args.os_dir, defined_function_names)
+    calling_conventions = dict()
+    if args.fast_calls:
+        with metrics.phase("optimize.calling_conventions"):
+            all_commands = [command for _, commands in program for command in commands]
+            calling_conventions = analyze_calling_conventions(all_commands, intrinsics)
+    code_writer = CodeWriter(output_file_path, metrics, intrinsics, calling_conventions)
+    if args.bootstrap:
+        position = code_writer.get_position()
+        with metrics.phase("codegen." + BOOTSTRAP_METRICS_NAME):
+            code_writer.write_comment("bootstrap")
+            code_writer.write_bootstrap()
+        if metrics.enabled:
+            assembly = code_writer.get_assembly_since(position)
+            metrics.add_instructions(BOOTSTRAP_METRICS_NAME, BOOTSTRAP_METRICS_NAME, count_instructions(assembly))
+    for filename, commands in program:
+        code_writer.start_file()
+        function_name = TOP_LEVEL_FUNCTION_NAME
+        for command in commands:
+            command_type = command[1]
+            if command_type == FUNCTION_COMMAND_TYPE:
+                function_name = command[2]
+            position = code_writer.get_position()
+            with metrics.phase("codegen." + command_type):
+                write_command(code_writer, command, filename)
+            if metrics.enabled:
+                assembly = code_writer.get_assembly_since(position)
+                metrics.add_instructions(command_type, function_name, count_instructions(assembly))
 
     code_writer.close()
+    if metrics.enabled:
+        metrics.write(args.metrics, args.metrics_format)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Translate VM code into Hack assembly code')
-    parser.add_argument('file_path', help='path to VM code file')
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help='VM code file(s) or a directory of them, translated together into one program')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output file path (default: file.asm for a single file, dir/dir.asm for a '
+                             'directory; required for several paths)')
+    parser.add_argument('--bootstrap', action='store_true',
+                        help='start the output with code that sets SP to 256 and calls Sys.init')
+    parser.add_argument('--metrics', metavar='METRICS_FILE_PATH', default=None,
+                        help='record per-phase wall time, allocated bytes (traced with tracemalloc, which '
+                             'slows translation down), net change in allocated memory blocks and '
+                             'instruction counts to this file')
+    parser.add_argument('--metrics-format', choices=[JSON_METRICS_FORMAT, PROMETHEUS_METRICS_FORMAT], default=None,
+                        help='metrics file format (default: prometheus for .prom files, json otherwise)')
+    parser.add_argument('--no-control-flow-optimization', dest='optimize_control_flow', action='store_false',
+                        help='translate label, goto and if-goto one at a time instead of optimizing each '
+                             'function\'s control flow graph')
+    parser.add_argument('--fast-calls', action='store_true',
+                        help='use reduced frames for functions that never call anything or never change '
+                             'THIS/THAT. only safe when every file calling these functions is translated '
+                             'in the same run')
+    parser.add_argument('--intrinsics', type=parse_intrinsic_names, default=ALL_INTRINSICS,
+                        help='comma separated OS functions to inline at call sites, "all" or "none"; '
+                             'functions defined by the translated program are never inlined '
+                             '(available: {})'.format(", ".join(sorted(INTRINSICS))))
+    parser.add_argument('--os-dir', default=None,
+                        help='directory with the Jack OS sources; intrinsics whose OS function signature '
+                             'no longer appears there are disabled (function bodies are not checked)')
     args = parser.parse_args()
+    if len(args.paths) > 1 and args.output is None:
+        parser.error("--output is required when translating several paths")
     main(args)